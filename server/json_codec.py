@@ -0,0 +1,17 @@
+# JSON encoding shared by the signaling server and the relay.
+# orjson when installed, else the stdlib with compact separators; both
+# return str, ready for websocket.send_text().
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    import json
+
+    json_loads = json.loads
+
+    def json_dumps(obj) -> str:
+        return json.dumps(obj, separators=(",", ":"))
@@ -1,16 +1,25 @@
 # main.py - Fixed FastAPI Backend (Reliable Pairing)
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Response
+from fastapi import FastAPI, WebSocket, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
-import json
 import asyncio
-import uuid
-from typing import Dict, Optional
-from datetime import datetime, timedelta
+import logging
+from collections import OrderedDict, deque
+from typing import Optional
 from pathlib import Path
 import os
-import random
+import secrets
+import time
+
+try:
+    from .models import Session
+    from .json_codec import json_dumps, json_loads
+except ImportError:  # run directly as `python main.py`
+    from models import Session
+    from json_codec import json_dumps, json_loads
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("sonicshare")
 
 app = FastAPI()
 
@@ -23,94 +32,104 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Session storage with automatic cleanup
+# Constant frames, serialized once instead of per send_json() call
+_PING_JSON = '{"type":"ping"}'
+_PONG_JSON = '{"type":"pong"}'
+_PEER_READY_JSON = '{"type":"peer_ready","message":"Ready to transfer"}'
+
+# Seconds of inactivity (time.monotonic) after which a session expires
+SESSION_TIMEOUT = 600.0
+
+# Session storage with lazy expiration (checked on lookup and insert)
 class SessionManager:
     def __init__(self):
-        self.sessions: Dict[str, dict] = {}
-        self.cleanup_task = None
-    
-    async def start_cleanup(self):
-        while True:
-            await asyncio.sleep(60)  # Every minute
-            self._cleanup_stale_sessions()
+        # Ordered by last_activity (oldest first) so cleanup can stop early
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
     
     def _cleanup_stale_sessions(self):
-        now = datetime.now()
-        stale = []
-        for code, session in self.sessions.items():
-            if now - session.get('last_activity', now) > timedelta(minutes=10):
-                stale.append(code)
-        for code in stale:
-            del self.sessions[code]
-            print(f"[Cleanup] Removed stale session: {code}")
+        now = time.monotonic()
+        while self.sessions:
+            code, session = next(iter(self.sessions.items()))
+            if now - session.last_activity <= SESSION_TIMEOUT:
+                break
+            self.sessions.popitem(last=False)
+            logger.info("[Cleanup] Removed stale session: %s", code)
+    
+    def generate_code(self) -> str:
+        # Only for POSTs that bring no code of their own. create_session()
+        # overwrites on assignment, so skip codes a live sender already holds;
+        # a bounded retry keeps a nearly full space from spinning the request
+        for _ in range(8):
+            code = f"{secrets.randbelow(1_000_000):06d}"
+            if code not in self.sessions:
+                return code
+        raise RuntimeError("session space exhausted")
     
-    def create_session(self, code: str, offer: dict) -> dict:
-        self.sessions[code] = {
-            'code': code,
-            'offer': offer,
-            'answer': None,
-            'sender_ws': None,
-            'receiver_ws': None,
-            # Unified ICE buffer: keyed by recipient role
-            # sender_ice = candidates FROM sender, TO be delivered TO receiver
-            # receiver_ice = candidates FROM receiver, TO be delivered TO sender
-            'sender_ice': [],
-            'receiver_ice': [],
-            # Pending signals queued when WS was not yet connected
-            'pending_for_sender': [],   # messages queued for sender
-            'pending_for_receiver': [], # messages queued for receiver
-            'created_at': datetime.now(),
-            'last_activity': datetime.now(),
-            'status': 'waiting'
-        }
+    def create_session(self, code: str, offer: dict) -> Session:
+        # Expire lazily on insert instead of running a periodic sweep
+        self._cleanup_stale_sessions()
+        self.sessions[code] = Session(code, offer, time.monotonic())
+        # Re-created codes keep their old slot on assignment; move to the tail
+        self.sessions.move_to_end(code)
         return self.sessions[code]
     
-    def get_session(self, code: str) -> Optional[dict]:
+    def get_session(self, code: str) -> Optional[Session]:
         session = self.sessions.get(code)
-        if session:
-            session['last_activity'] = datetime.now()
+        if session is None:
+            return None
+        if time.monotonic() - session.last_activity > SESSION_TIMEOUT:
+            del self.sessions[code]
+            logger.info("[Cleanup] Removed stale session: %s", code)
+            return None
+        self.touch(session)
         return session
     
-    def set_answer(self, code: str, answer: dict) -> bool:
+    def touch(self, session: Session):
+        session.last_activity = time.monotonic()
+        if self.sessions.get(session.code) is session:
+            self.sessions.move_to_end(session.code)
+    
+    def set_answer(self, code: str, answer: dict) -> Optional[Session]:
         session = self.get_session(code)
         if session:
-            session['answer'] = answer
-            session['status'] = 'connecting'
-            return True
-        return False
+            session.answer = answer
+            session.status = 'connecting'
+        return session
 
 session_manager = SessionManager()
 
-@app.on_event("startup")
-async def startup():
-    asyncio.create_task(session_manager.start_cleanup())
-
 # ---------------------------------------------------------------------------
 # REST API — Reliable SDP + ICE handshake
 # ---------------------------------------------------------------------------
 
+# Health is polled by load balancers: splice the one variable field into a
+# pre-built body instead of going through FastAPI's JSON encoder
+_HEALTH_PREFIX = '{"status":"ok","message":"SonicShare server is running","active_sessions":'
+_HEALTH_SUFFIX = '}'
+
 @app.get("/api/health")
 async def health_check():
-    return {
-        "status": "ok",
-        "message": "SonicShare server is running",
-        "active_sessions": len(session_manager.sessions)
-    }
+    return Response(
+        content=_HEALTH_PREFIX + str(len(session_manager.sessions)) + _HEALTH_SUFFIX,
+        media_type="application/json",
+    )
 
 @app.post("/api/session")
 async def create_session(data: dict):
     code = data.get('code')
     if not code:
-        code = "".join([str(random.randint(0, 9)) for _ in range(6)])
+        try:
+            code = session_manager.generate_code()
+        except RuntimeError:
+            return {"error": "No free session codes"}
     if len(code) != 6:
         return {"error": "Invalid code format"}
     
     session = session_manager.create_session(code, {
         'sdp': data.get('sdp'),
         'type': data.get('type'),
-        'ice_candidates': []
     })
-    print(f"[Session] Created: {code}")
+    logger.info("[Session] Created: %s", code)
     return {"code": code, "status": "created"}
 
 @app.get("/api/session/{code}")
@@ -120,9 +139,9 @@ async def get_session(code: str):
         return {"error": "Session not found"}
     return {
         "code": code,
-        "status": session['status'],
-        "offer": session['offer'],
-        "answer": session.get('answer'),
+        "status": session.status,
+        "offer": session.offer,
+        "answer": session.answer,
     }
 
 @app.post("/api/session/{code}/answer")
@@ -133,30 +152,29 @@ async def post_answer(code: str, data: dict):
     If the sender WS is already connected → push immediately.
     If not → queue it in pending_for_sender to be flushed when they connect.
     """
-    success = session_manager.set_answer(code, {
+    session = session_manager.set_answer(code, {
         'sdp': data.get('sdp'),
         'type': data.get('type')
     })
-    if not success:
+    if not session:
         return {"error": "Session not found"}
     
-    print(f"[Session] Answer received for: {code}")
+    logger.info("[Session] Answer received for: %s", code)
     
-    session = session_manager.get_session(code)
-    answer_msg = {'type': 'answer', 'answer': session['answer']}
+    answer_msg = {'type': 'answer', 'answer': session.answer}
     
-    sender_ws = session.get('sender_ws')
+    sender_ws = session.sender_ws
     if sender_ws:
         try:
-            await sender_ws.send_json(answer_msg)
-            print(f"[Session] Answer pushed to sender WS: {code}")
+            await sender_ws.send_text(json_dumps(answer_msg))
+            logger.debug("[Session] Answer pushed to sender WS: %s", code)
         except Exception as e:
-            print(f"[Error] Failed to push answer to sender: {e}")
-            session['pending_for_sender'].append(answer_msg)
+            logger.warning("[Error] Failed to push answer to sender: %s", e)
+            session.pending_for_sender.append(answer_msg)
     else:
         # Sender WS not yet connected — queue for flush on WS connect
-        session['pending_for_sender'].append(answer_msg)
-        print(f"[Session] Sender WS not ready, queued answer for: {code}")
+        session.pending_for_sender.append(answer_msg)
+        logger.debug("[Session] Sender WS not ready, queued answer for: %s", code)
     
     return {"status": "ok"}
 
@@ -175,23 +193,23 @@ async def add_ice_candidate(code: str, data: dict):
     
     # FROM sender → deliver TO receiver
     if role == 'sender':
-        target_ws = session.get('receiver_ws')
-        buffer_key = 'sender_ice'
+        target_ws = session.receiver_ws
+        buffer = session.sender_ice
     else:  # FROM receiver → deliver TO sender
-        target_ws = session.get('sender_ws')
-        buffer_key = 'receiver_ice'
+        target_ws = session.sender_ws
+        buffer = session.receiver_ice
     
     ice_msg = {'type': 'ice_candidate', 'candidate': candidate}
     
     if target_ws:
         try:
-            await target_ws.send_json(ice_msg)
+            await target_ws.send_text(json_dumps(ice_msg))
         except Exception as e:
-            print(f"[Error] Failed to forward ICE: {e}")
-            session[buffer_key].append(candidate)
+            logger.warning("[Error] Failed to forward ICE: %s", e)
+            buffer.append(candidate)
     else:
-        session[buffer_key].append(candidate)
-        print(f"[ICE] REST-buffered candidate from {role} (total: {len(session[buffer_key])})")
+        buffer.append(candidate)
+        logger.debug("[ICE] REST-buffered candidate from %s (total: %d)", role, len(buffer))
     
     return {"status": "ok"}
 
@@ -199,29 +217,121 @@ async def add_ice_candidate(code: str, data: dict):
 # WebSocket — real-time updates (ICE, status, keepalive)
 # ---------------------------------------------------------------------------
 
-async def _flush_pending(websocket: WebSocket, pending: list, label: str):
+async def _flush_pending(websocket: WebSocket, pending: deque, label: str):
     """Deliver any queued messages to a peer that just connected."""
     if not pending:
         return
-    print(f"[Flush] Sending {len(pending)} queued messages to {label}")
-    for msg in list(pending):
+    logger.debug("[Flush] Sending %d queued messages to %s", len(pending), label)
+    while pending:
+        msg = pending.popleft()
         try:
-            await websocket.send_json(msg)
+            if isinstance(msg, str):
+                await websocket.send_text(msg)
+            else:
+                await websocket.send_text(json_dumps(msg))
         except Exception as e:
-            print(f"[Flush] Error: {e}")
-    pending.clear()
+            logger.warning("[Flush] Error: %s", e)
 
-async def _flush_ice(websocket: WebSocket, ice_buffer: list, label: str):
-    """Deliver buffered ICE candidates to a peer that just connected."""
+async def _flush_ice(websocket: WebSocket, ice_buffer: deque, label: str,
+                     batch: bool = False):
+    """Deliver buffered ICE candidates to a peer that just connected.
+
+    Clients that connected with ``?batch=1`` get every candidate in a single
+    ``ice_candidate_batch`` frame; older clients get one frame per candidate.
+    """
     if not ice_buffer:
         return
-    print(f"[ICE] Flushing {len(ice_buffer)} buffered candidates to {label}")
-    for candidate in list(ice_buffer):
+    logger.debug("[ICE] Flushing %d buffered candidates to %s", len(ice_buffer), label)
+    if batch and len(ice_buffer) > 1:
+        candidates = list(ice_buffer)
+        ice_buffer.clear()
         try:
-            await websocket.send_json({'type': 'ice_candidate', 'candidate': candidate})
+            await websocket.send_text(json_dumps(
+                {'type': 'ice_candidate_batch', 'candidates': candidates}
+            ))
         except Exception as e:
-            print(f"[ICE] Flush error: {e}")
-    ice_buffer.clear()
+            logger.warning("[ICE] Flush error: %s", e)
+        return
+    while ice_buffer:
+        candidate = ice_buffer.popleft()
+        try:
+            await websocket.send_text(json_dumps({'type': 'ice_candidate', 'candidate': candidate}))
+        except Exception as e:
+            logger.warning("[ICE] Flush error: %s", e)
+
+async def _heartbeat(websocket: WebSocket):
+    """Ping the peer every 30s; one timer per connection, not per message."""
+    try:
+        while True:
+            await asyncio.sleep(30.0)
+            await websocket.send_text(_PING_JSON)
+    except Exception:
+        pass  # socket closed; the receive loop handles teardown
+
+# Per-type WebSocket message handlers, dispatched through _WS_HANDLERS.
+# Each receives the parsed message and the raw text frame it came from.
+
+async def _handle_ping(websocket: WebSocket, session: Session, role: str, msg: dict, data: str):
+    await websocket.send_text(_PONG_JSON)
+
+async def _handle_pong(websocket: WebSocket, session: Session, role: str, msg: dict, data: str):
+    pass  # keepalive acknowledged
+
+async def _handle_ice(websocket: WebSocket, session: Session, role: str, msg: dict, data: str):
+    # FROM this role → forward TO the other peer
+    if role == 'sender':
+        target_ws = session.receiver_ws
+        buffer = session.sender_ice
+    else:
+        target_ws = session.sender_ws
+        buffer = session.receiver_ice
+    
+    # Clients already send {"type":"ice_candidate","candidate":...},
+    # the exact frame the peer expects: relay it without re-encoding
+    if target_ws:
+        try:
+            await target_ws.send_text(data)
+        except Exception:
+            buffer.append(msg.get('candidate'))
+    else:
+        buffer.append(msg.get('candidate'))
+        logger.debug("[ICE] WS-buffered from %s (total: %d)", role, len(buffer))
+
+async def _handle_ready(websocket: WebSocket, session: Session, role: str, msg: dict, data: str):
+    session.status = 'connected'
+    # Notify the other peer; if not connected, queue it
+    if role == 'sender':
+        target_ws = session.receiver_ws
+        queue = session.pending_for_receiver
+    else:
+        target_ws = session.sender_ws
+        queue = session.pending_for_sender
+    
+    if target_ws:
+        try:
+            await target_ws.send_text(_PEER_READY_JSON)
+        except Exception:
+            queue.append(_PEER_READY_JSON)
+    else:
+        queue.append(_PEER_READY_JSON)
+        logger.debug("[Ready] Other peer not connected yet, queued for %s", session.code)
+
+async def _handle_complete(websocket: WebSocket, session: Session, role: str, msg: dict, data: str):
+    session.status = 'completed'
+    logger.info("[Session] Transfer completed: %s", session.code)
+
+async def _handle_failed(websocket: WebSocket, session: Session, role: str, msg: dict, data: str):
+    session.status = 'failed'
+    logger.info("[Session] Transfer failed: %s", session.code)
+
+_WS_HANDLERS = {
+    'ping': _handle_ping,
+    'pong': _handle_pong,
+    'ice_candidate': _handle_ice,
+    'transfer_ready': _handle_ready,
+    'transfer_complete': _handle_complete,
+    'transfer_failed': _handle_failed,
+}
 
 @app.websocket("/ws/{code}/{role}")
 async def websocket_endpoint(websocket: WebSocket, code: str, role: str):
@@ -233,103 +343,50 @@ async def websocket_endpoint(websocket: WebSocket, code: str, role: str):
         await websocket.close()
         return
     
+    # Clients opt in to batched ICE delivery during the handshake
+    batch_ice = websocket.query_params.get('batch') == '1'
+    
     # Register this peer's WebSocket
     if role == 'sender':
-        session['sender_ws'] = websocket
+        session.sender_ws = websocket
         # Flush any answer / ICE that arrived from receiver before sender WS was open
-        await _flush_pending(websocket, session['pending_for_sender'], 'sender')
-        await _flush_ice(websocket, session['receiver_ice'], 'sender')
+        await _flush_pending(websocket, session.pending_for_sender, 'sender')
+        await _flush_ice(websocket, session.receiver_ice, 'sender', batch_ice)
     else:
-        session['receiver_ws'] = websocket
+        session.receiver_ws = websocket
         # Flush any ICE that arrived from sender before receiver WS was open
-        await _flush_ice(websocket, session['sender_ice'], 'receiver')
+        await _flush_ice(websocket, session.sender_ice, 'receiver', batch_ice)
         # Also flush any pending messages for receiver
-        await _flush_pending(websocket, session['pending_for_receiver'], 'receiver')
+        await _flush_pending(websocket, session.pending_for_receiver, 'receiver')
     
-    print(f"[WebSocket] {role} connected to session {code}")
+    logger.info("[WebSocket] %s connected to session %s", role, code)
+    heartbeat = asyncio.create_task(_heartbeat(websocket))
     
     try:
-        while True:
-            try:
-                data = await asyncio.wait_for(
-                    websocket.receive_text(),
-                    timeout=30.0
-                )
-            except asyncio.TimeoutError:
-                await websocket.send_json({"type": "ping"})
-                continue
-            
-            msg = json.loads(data)
+        async for data in websocket.iter_text():
+            msg = json_loads(data)
             msg_type = msg.get('type')
-            session['last_activity'] = datetime.now()
-            
-            if msg_type == 'ping':
-                await websocket.send_json({"type": "pong"})
-            
-            elif msg_type == 'pong':
-                pass  # keepalive acknowledged
+            session_manager.touch(session)
             
-            elif msg_type == 'ice_candidate':
-                # FROM this role → forward TO the other peer
-                if role == 'sender':
-                    target_ws = session.get('receiver_ws')
-                    buffer = session['sender_ice']
-                else:
-                    target_ws = session.get('sender_ws')
-                    buffer = session['receiver_ice']
-                
-                ice_msg = {'type': 'ice_candidate', 'candidate': msg.get('candidate')}
-                if target_ws:
-                    try:
-                        await target_ws.send_json(ice_msg)
-                    except Exception:
-                        buffer.append(msg.get('candidate'))
-                else:
-                    buffer.append(msg.get('candidate'))
-                    print(f"[ICE] WS-buffered from {role} (total: {len(buffer)})")
-            
-            elif msg_type == 'transfer_ready':
-                session['status'] = 'connected'
-                # Notify the other peer; if not connected, queue it
-                if role == 'sender':
-                    target_ws = session.get('receiver_ws')
-                    queue = session['pending_for_receiver']
-                else:
-                    target_ws = session.get('sender_ws')
-                    queue = session['pending_for_sender']
-                
-                ready_msg = {'type': 'peer_ready', 'message': 'Ready to transfer'}
-                if target_ws:
-                    try:
-                        await target_ws.send_json(ready_msg)
-                    except Exception:
-                        queue.append(ready_msg)
-                else:
-                    queue.append(ready_msg)
-                    print(f"[Ready] Other peer not connected yet, queued for {code}")
-            
-            elif msg_type == 'transfer_complete':
-                session['status'] = 'completed'
-                print(f"[Session] Transfer completed: {code}")
-            
-            elif msg_type == 'transfer_failed':
-                session['status'] = 'failed'
-                print(f"[Session] Transfer failed: {code}")
-                    
-    except WebSocketDisconnect:
-        print(f"[WebSocket] {role} disconnected from {code}")
+            handler = _WS_HANDLERS.get(msg_type)
+            if handler:
+                await handler(websocket, session, role, msg, data)
+        
+        # iter_text() ends on WebSocketDisconnect
+        logger.info("[WebSocket] %s disconnected from %s", role, code)
     except Exception as e:
-        print(f"[WebSocket] Error with {role} in {code}: {e}")
+        logger.warning("[WebSocket] Error with %s in %s: %s", role, code, e)
     finally:
+        heartbeat.cancel()
         if role == 'sender':
-            session['sender_ws'] = None
+            session.sender_ws = None
         else:
-            session['receiver_ws'] = None
+            session.receiver_ws = None
         
-        if session and not session.get('sender_ws') and not session.get('receiver_ws'):
-            if session['status'] not in ['completed', 'failed']:
-                session['status'] = 'failed'
-                print(f"[Session] Both peers disconnected: {code}")
+        if session and not session.sender_ws and not session.receiver_ws:
+            if session.status not in ['completed', 'failed']:
+                session.status = 'failed'
+                logger.info("[Session] Both peers disconnected: %s", code)
 
 # ---------------------------------------------------------------------------
 # Static file serving
@@ -344,33 +401,25 @@ async def favicon():
 
 app.mount("/static", StaticFiles(directory=str(WEB_DIR)), name="static")
 
-@app.get("/sender.html")
-async def sender():
-    response = FileResponse(WEB_DIR / "sender.html")
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    return response
-
-@app.get("/receiver.html")
-async def receiver_page():
-    response = FileResponse(WEB_DIR / "receiver.html")
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    return response
-
-@app.get("/")
-@app.get("/index.html")
-async def index():
-    response = FileResponse(WEB_DIR / "index.html")
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    return response
-
-@app.get("/{filename}.html")
-async def serve_generic_html(filename: str):
-    file_path = WEB_DIR / f"{filename}.html"
-    if file_path.exists():
-        return FileResponse(file_path)
-    return Response(status_code=404)
+_NOCACHE_HEADERS = {"Cache-Control": "no-cache, no-store, must-revalidate"}
+
+class PageFiles(StaticFiles):
+    """StaticFiles that marks HTML pages no-cache; assets keep ETag caching."""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if str(full_path).endswith(".html"):
+            response.headers.update(_NOCACHE_HEADERS)
+        return response
+
+# Pages are served natively by StaticFiles (sendfile, ETag/If-Modified-Since).
+# html=True maps "/" to index.html. Mounted last so API and WS routes win.
+app.mount("/", PageFiles(directory=str(WEB_DIR), html=True), name="root")
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # loop="auto" picks uvloop when installed (uvicorn[standard]), else asyncio.
+    # permessage-deflate is off: relayed payloads are encrypted and don't compress.
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="auto",
+                ws_per_message_deflate=False)
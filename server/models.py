@@ -1,8 +1,32 @@
+from collections import deque
 from typing import Optional
 from fastapi import WebSocket
 
 class Session:
-    def __init__(self, code: str, sender: WebSocket):
+    """One signaling session between a sender and a receiver.
+
+    Uses __slots__ so each live session costs a fixed-size object rather
+    than a per-instance dict.
+    """
+    __slots__ = (
+        "code", "offer", "answer", "sender_ws", "receiver_ws",
+        "sender_ice", "receiver_ice", "pending_for_sender",
+        "pending_for_receiver", "last_activity", "status",
+    )
+
+    def __init__(self, code: str, offer: dict, now: float):
         self.code = code
-        self.sender = sender
-        self.receiver: Optional[WebSocket] = None
+        self.offer = offer
+        self.answer: Optional[dict] = None
+        self.sender_ws: Optional[WebSocket] = None
+        self.receiver_ws: Optional[WebSocket] = None
+        # Unified ICE buffer: keyed by recipient role
+        # sender_ice = candidates FROM sender, TO be delivered TO receiver
+        # receiver_ice = candidates FROM receiver, TO be delivered TO sender
+        self.sender_ice: deque = deque()
+        self.receiver_ice: deque = deque()
+        # Pending signals queued when WS was not yet connected
+        self.pending_for_sender: deque = deque()    # messages queued for sender
+        self.pending_for_receiver: deque = deque()  # messages queued for receiver
+        self.last_activity = now
+        self.status = 'waiting'
@@ -1,6 +1,10 @@
 from fastapi import WebSocket
+from json_codec import json_dumps
 from session_manager import SessionManager
 
+# Allowed packet types for forwarding
+ALLOWED_TYPES = frozenset(["DATA", "ACK", "RESUME", "END", "ERROR", "KEY_EXCHANGE", "KEY", "START", "HASH", "OFFER", "ANSWER", "ICE"])
+
 class PacketRouter:
     def __init__(self, session_manager: SessionManager):
         self.manager = session_manager
@@ -8,14 +12,12 @@ class PacketRouter:
     async def route(self, websocket: WebSocket, message: dict):
         msg_type = message.get("type")
         
-        # Allowed packet types for forwarding
-        ALLOWED_TYPES = ["DATA", "ACK", "RESUME", "END", "ERROR", "KEY_EXCHANGE", "KEY", "START", "HASH", "OFFER", "ANSWER", "ICE"]
-        
         if msg_type in ALLOWED_TYPES:
             session = self.manager.find_session_by_websocket(websocket)
             if session:
-                target = session.receiver if websocket == session.sender else session.sender
+                target = session.peer_of.get(websocket)
                 if target:
-                    await target.send_json(message)
-                    return True
+                    # Same bounded queue as SessionManager.relay: order is kept
+                    # and a full queue makes the router wait too
+                    return await session.send(target, json_dumps(message), mergeable=True)
         return False
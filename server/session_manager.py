@@ -1,40 +1,184 @@
-import random
+import logging
+import secrets
 import time
 import asyncio
+from itertools import islice
+
+from json_codec import json_dumps, json_loads
+
+logger = logging.getLogger("sonicshare")
+
+SESSION_TIMEOUT = 10 * 60 # 10 minutes
+# Sessions probed for expiry on each create()
+PROBE_COUNT = 4
+
+# Max server-encoded text frames merged into one {"type":"BATCH","msgs":[...]} frame
+BATCH_MAX = 32
+# Frames buffered per peer before relay awaits (~2 MB of 32 KB chunks); this is
+# what slows a fast sender down to its receiver's pace
+QUEUE_MAX = 64
+# Seconds a closing session's writers get to flush what is already queued
+DRAIN_TIMEOUT = 5.0
+
+# Queue sentinel: the writer sends everything queued before it, then exits
+_CLOSE = object()
+
+# Writer shutdowns still draining; held here so the tasks are not collected
+_closing = set()
 
 class Session:
-    def __init__(self, code):
+    def __init__(self, code, on_writer_failed=None):
         self.code = code
         self.clients = []
         self.last_activity = time.time()
+        # Per-client outbound queue (ws -> asyncio.Queue) drained by one writer task
+        self.out_queues = {}
+        self._writers = {}
+        # ws -> the other client, filled in once the session has both peers
+        self.peer_of = {}
+        self._on_writer_failed = on_writer_failed
 
     def touch(self):
         self.last_activity = time.time()
 
+    def add_client(self, ws):
+        self.clients.append(ws)
+        queue = asyncio.Queue(maxsize=QUEUE_MAX)
+        self.out_queues[ws] = queue
+        self._writers[ws] = asyncio.create_task(self._writer(ws, queue))
+
+    async def send(self, ws, frame, mergeable=False):
+        """Queue an encoded frame (str or bytes) for ws, waiting while its queue is full.
+
+        Only frames the server encoded itself are passed with mergeable=True;
+        those are the ones the writer may splice into a BATCH frame.
+        """
+        queue = self.out_queues.get(ws)
+        if queue is None:
+            return False  # closed, or its writer failed
+        await queue.put((frame, mergeable))
+        return True
+
+    def close(self):
+        # Stop accepting frames, but let each writer flush what is already queued
+        for ws, queue in self.out_queues.items():
+            task = asyncio.create_task(self._shutdown_writer(queue, self._writers[ws]))
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+        self._writers.clear()
+        self.out_queues.clear()
+
+    async def _shutdown_writer(self, queue, writer):
+        async def drain():
+            await queue.put(_CLOSE)
+            await writer
+
+        try:
+            await asyncio.wait_for(drain(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("[%s] Writer did not drain in %.0fs, dropping %d frames",
+                           self.code, DRAIN_TIMEOUT, queue.qsize())
+        finally:
+            writer.cancel()
+            _release(queue)
+
+    async def _writer(self, ws, queue):
+        # Queue items are (frame, mergeable) pairs or _CLOSE. Adjacent mergeable
+        # text frames are spliced as-is into one BATCH frame, so nothing is
+        # re-encoded; every other frame goes out on its own.
+        try:
+            while True:
+                item = await queue.get()
+                if item is _CLOSE:
+                    return
+                frame, mergeable = item
+                if not mergeable:
+                    await _send_frame(ws, frame)
+                    continue
+
+                batch = [frame]
+                tail = None
+                while len(batch) < BATCH_MAX and not queue.empty():
+                    item = queue.get_nowait()
+                    if item is _CLOSE or not item[1]:
+                        tail = item  # keep frame order: flush the batch first
+                        break
+                    batch.append(item[0])
+
+                if len(batch) == 1:
+                    await ws.send_text(batch[0])
+                else:
+                    await ws.send_text('{"type":"BATCH","msgs":[' + ",".join(batch) + "]}")
+                if tail is _CLOSE:
+                    return
+                if tail is not None:
+                    await _send_frame(ws, tail[0])
+        except Exception as e:
+            logger.warning("[%s] Writer stopped: %s", self.code, e)
+            # Stop queueing for this peer and unblock any relay waiting on put()
+            if self.out_queues.get(ws) is queue:
+                del self.out_queues[ws]
+                del self._writers[ws]
+            _release(queue)
+            if self._on_writer_failed:
+                self._on_writer_failed(self)
+
+async def _send_frame(ws, frame):
+    if isinstance(frame, bytes):
+        await ws.send_bytes(frame)
+    else:
+        await ws.send_text(frame)
+
+def _log_relay(code, data):
+    # Debug output only, so it must not raise on whatever a client sent:
+    # non-object frames are noted, and only an integer seq is used to throttle
+    if not isinstance(data, dict):
+        logger.debug("[%s] Relaying non-object frame", code)
+        return
+    msg_type = data.get("type", "UNKNOWN")
+    seq = data.get("seq")
+    if msg_type == "DATA" and isinstance(seq, int) and seq % 500:
+        return
+    logger.debug("[%s] Relaying %s%s", code, msg_type,
+                 f" seq:{seq}" if seq is not None else "")
+
+def _release(queue):
+    # Empty a queue nobody reads any more, waking relays blocked in put()
+    while not queue.empty():
+        queue.get_nowait()
+
 class SessionManager:
     def __init__(self):
         self.sessions = {}
         self.client_map = {} # ws -> code
-        self._prune_task = None
-
-    def start_cleanup_task(self):
-        if self._prune_task is None:
-            self._prune_task = asyncio.create_task(self._periodic_prune())
-
-    async def _periodic_prune(self):
-        while True:
-            await asyncio.sleep(60) # Only check once a minute to save CPU
-            now = time.time()
-            timeout = 10 * 60 # 10 minutes
-            
-            idle_codes = [
-                code for code, session in self.sessions.items()
-                if now - session.last_activity > timeout
-            ]
-            
-            for code in idle_codes:
-                print(f"⏰ Session {code} timed out due to inactivity (10m)")
+
+    def _writer_failed(self, session):
+        # A peer that can't be written to ends the session, as a disconnect would
+        if self.sessions.get(session.code) is session:
+            logger.info("Cleanup: Removing session %s after a failed send", session.code)
+            self._delete_session(session.code)
+
+    def _live_session(self, code):
+        # Lazy expiration: a session idle past the timeout is deleted on access
+        session = self.sessions.get(code)
+        if session and time.time() - session.last_activity > SESSION_TIMEOUT:
+            logger.info("⏰ Session %s timed out due to inactivity (10m)", code)
+            self._delete_session(code)
+            return None
+        return session
+
+    def _expire_some(self):
+        # Bounded probe on insert: check the PROBE_COUNT oldest-inserted sessions
+        # and rotate live ones to the back, so repeated creates cycle through all
+        now = time.time()
+        for code in tuple(islice(self.sessions, PROBE_COUNT)):
+            session = self.sessions[code]
+            if now - session.last_activity > SESSION_TIMEOUT:
+                logger.info("⏰ Session %s timed out due to inactivity (10m)", code)
                 self._delete_session(code)
+            else:
+                del self.sessions[code]
+                self.sessions[code] = session
 
     def _delete_session(self, code):
         if code in self.sessions:
@@ -42,26 +186,34 @@ class SessionManager:
             for ws in session.clients:
                 if ws in self.client_map:
                     del self.client_map[ws]
+            session.close()
             del self.sessions[code]
 
     def generate_code(self):
-        return str(random.randint(100000, 999999))
+        # Room codes are always server-picked; a code still in self.sessions
+        # belongs to a live room, so draw again rather than orphan its clients
+        for _ in range(8):
+            code = str(secrets.randbelow(900000) + 100000)
+            if code not in self.sessions:
+                return code
+        raise RuntimeError("session space exhausted")
 
     async def create(self, ws):
-        self.start_cleanup_task()
+        self._expire_some()
         code = self.generate_code()
-        self.sessions[code] = Session(code)
-        self.sessions[code].clients.append(ws)
+        session = Session(code, self._writer_failed)
+        self.sessions[code] = session
+        session.add_client(ws)
         self.client_map[ws] = code
-        await ws.send_json({"type": "CODE", "code": code})
-        print(f"Session Created: {code}")
+        await session.send(ws, json_dumps({"type": "CODE", "code": code}))
+        logger.info("Session Created: %s", code)
 
     async def join(self, ws, code):
-        print(f"Attempting to join session: '{code}'")
-        session = self.sessions.get(code)
+        logger.debug("Attempting to join session: '%s'", code)
+        session = self._live_session(code)
 
         if not session:
-            print(f"❌ JOIN FAILED: Code '{code}' not found.")
+            logger.info("❌ JOIN FAILED: Code '%s' not found.", code)
             await ws.send_json({"type": "ERROR", "msg": "INVALID_CODE"})
             return
 
@@ -69,54 +221,91 @@ class SessionManager:
             await ws.send_json({"type": "ERROR", "msg": "SESSION_FULL"})
             return
 
-        session.clients.append(ws)
+        session.add_client(ws)
         self.client_map[ws] = code
         session.touch()
 
         if len(session.clients) == 2:
+            # READY goes through the writers and is queued before peer_of is
+            # set, so no relayed frame can overtake it
+            ready = json_dumps({"type": "READY", "code": code})
             for c in session.clients:
-                await c.send_json({
-                    "type": "READY",
-                    "code": code
-                })
-            print(f"Session {code} is READY")
+                await session.send(c, ready)
+            a, b = session.clients
+            session.peer_of = {a: b, b: a}
+            logger.info("Session %s is READY", code)
 
+    # Relay hot path: never create_task() per message. Frames are put on the
+    # peer's queue and sent by the writer task started once in add_client();
+    # awaiting a full queue is the backpressure on a fast sender.
     async def relay(self, ws, data):
         code = self.client_map.get(ws)
         if not code:
             return
 
-        session = self.sessions.get(code)
+        session = self._live_session(code)
         if not session:
             return
 
         session.touch()
-        msg_type = data.get("type", "UNKNOWN")
         
-        # Throttled logging for data transfer
-        if msg_type != "DATA" or data.get("seq", 0) % 500 == 0:
-            print(f"[{code}] Relaying {msg_type}" + (f" seq:{data.get('seq')}" if 'seq' in data else ""))
+        # Throttled logging for data transfer; nothing is built unless DEBUG is on
+        if logger.isEnabledFor(logging.DEBUG):
+            _log_relay(code, data)
+
+        peer = session.peer_of.get(ws)
+        if peer:
+            await session.send(peer, json_dumps(data), mergeable=True)
+
+    async def relay_text(self, ws, raw):
+        """Forward an undecoded text frame, so the same string goes to every peer."""
+        code = self.client_map.get(ws)
+        if not code:
+            return
+
+        session = self._live_session(code)
+        if not session:
+            return
+
+        session.touch()
+        # The frame is only ever parsed for the log line: skipped entirely below
+        # DEBUG, and DATA frames are sniffed ("type" leads the frame) rather than parsed
+        if logger.isEnabledFor(logging.DEBUG) and '"DATA"' not in raw[:40]:
+            try:
+                data = json_loads(raw)
+            except ValueError:
+                logger.debug("[%s] Relaying unparsed frame %r", code, raw[:40])
+            else:
+                _log_relay(code, data)
 
-        for c in session.clients:
-            if c != ws:
-                await c.send_json(data)
+        peer = session.peer_of.get(ws)
+        if peer:
+            await session.send(peer, raw)
 
     async def relay_binary(self, ws, data):
         code = self.client_map.get(ws)
         if not code:
             return
 
-        session = self.sessions.get(code)
+        session = self._live_session(code)
         if not session:
             return
 
         session.touch()
-        for c in session.clients:
-            if c != ws:
-                await c.send_bytes(data)
+        # Binary frames share the queue so they stay ordered with text frames
+        peer = session.peer_of.get(ws)
+        if peer:
+            await session.send(peer, bytes(data))
+
+    def find_session_by_websocket(self, ws):
+        # client_map is the ws -> code reverse index kept by create/join/_delete_session
+        code = self.client_map.get(ws)
+        if not code:
+            return None
+        return self.sessions.get(code)
 
     def disconnect(self, ws):
         code = self.client_map.get(ws)
         if code:
-            print(f"Cleanup: Removing session {code} due to disconnect")
+            logger.info("Cleanup: Removing session %s due to disconnect", code)
             self._delete_session(code)
@@ -61,7 +61,8 @@ export class SonicSignaling {
   // WebSocket only for ICE candidates and status updates
   async connectWebSocket() {
     return new Promise((resolve, reject) => {
-      const wsUrl = `${this.wsUrl}/ws/${this.code}/${this.role}`;
+      // batch=1: server may flush buffered ICE as one ice_candidate_batch frame
+      const wsUrl = `${this.wsUrl}/ws/${this.code}/${this.role}?batch=1`;
 
       console.log(
         `[Signaling] Connecting WS for ${this.role} on ${this.code}...`,
@@ -113,6 +114,14 @@ export class SonicSignaling {
               m.handleMessage({ type: "ICE", payload: msg.candidate }),
             );
             break;
+          case "ice_candidate_batch":
+            for (const candidate of msg.candidates) {
+              if (this.onIceCandidate) this.onIceCandidate(candidate);
+              import("./protocol.js").then((m) =>
+                m.handleMessage({ type: "ICE", payload: candidate }),
+              );
+            }
+            break;
           case "peer_ready":
             if (this.onPeerReady) this.onPeerReady();
             import("./protocol.js").then((m) =>
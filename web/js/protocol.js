@@ -406,6 +406,12 @@ async function trySend() {
 }
 
 export async function handleMessage(msg) {
+  // Relay server may coalesce queued frames into one BATCH envelope
+  if (msg.type === "BATCH") {
+    for (const inner of msg.msgs) await handleMessage(inner);
+    return;
+  }
+
   if (msg.type === "OFFER") await handleOffer(msg.payload);
   if (msg.type === "ANSWER") await handleAnswer(msg.payload);
   if (msg.type === "ICE") await handleCandidate(msg.payload);
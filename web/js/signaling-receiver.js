@@ -38,7 +38,8 @@ export class SonicSignaling {
 
   connectWebSocket() {
     return new Promise((resolve, reject) => {
-      const wsUrl = `${this.wsUrl}/ws/${this.code}/${this.role}`;
+      // batch=1: server may flush buffered ICE as one ice_candidate_batch frame
+      const wsUrl = `${this.wsUrl}/ws/${this.code}/${this.role}?batch=1`;
 
       console.log("[Signaling] Connecting to:", wsUrl);
 
@@ -88,6 +89,13 @@ export class SonicSignaling {
           this.onIceCandidate(msg.candidate);
         }
         break;
+      case "ice_candidate_batch":
+        if (this.onIceCandidate) {
+          for (const candidate of msg.candidates) {
+            this.onIceCandidate(candidate);
+          }
+        }
+        break;
       case "peer_ready":
         if (this.onPeerReady) {
           this.onPeerReady();